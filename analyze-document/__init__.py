@@ -2,28 +2,65 @@
 import logging
 import azure.functions as func
 import os
-import json
-import re
+import orjson
 import datetime
 import uuid
+import threading
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
+from azure.core.polling.base_polling import LROBasePolling
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeDocumentRequest
-from azure.storage.blob import BlobServiceClient, BlobSasPermissions, generate_blob_sas
-from pymongo import MongoClient
 from dotenv import load_dotenv
+from shared_code import database, storage
+from shared_code.transport import TRANSPORT
+from shared_code.utils import check_content_length, get_username, parse_form, read_upload
 
 # Load environment variables
 load_dotenv()
 
+# SDK clients are reused across invocations so requests share one connection pool
+_client_lock = threading.Lock()
+_di_client_cache = {}
+
+# Largest accepted upload
+_MAX_UPLOAD_MB = int(os.getenv("DOCUMENT_MAX_UPLOAD_MB", "50"))
+
+# Attribute holding the typed value for each Document Intelligence field type
+_VALUE_ATTR = {
+    "string": "value_string",
+    "number": "value_number",
+    "integer": "value_integer",
+    "date": "value_date",
+    "time": "value_time",
+    "phoneNumber": "value_phone_number",
+    "selectionMark": "value_selection_mark",
+    "countryRegion": "value_country_region",
+    "currency": "value_currency",
+    "address": "value_address",
+    "boolean": "value_boolean",
+}
+
+# Models to try, in order of preference (receipt models first)
+_ANALYZE_MODELS = ("prebuilt-receipt", "prebuilt-invoice", "prebuilt-document", "prebuilt-layout")
+# Models each Document Intelligence endpoint reported as not available
+_unavailable_models = {}
+# Seconds between analysis status polls; most documents take several seconds to process
+_POLLING_INTERVAL = float(os.environ.get("DOCUMENT_INTELLIGENCE_POLLING_INTERVAL", "5"))
+
 def main(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Python HTTP trigger function for receipt and bill analysis.')
+    logging.debug('Python HTTP trigger function for receipt and bill analysis.')
     
     try:
+        # Reject oversized uploads before the multipart body is parsed
+        too_large = check_content_length(req, _MAX_UPLOAD_MB)
+        if too_large is not None:
+            return too_large
+        
         # Check if the request contains a file upload
         if not req.files:
             return func.HttpResponse(
-                json.dumps({"error": "No file uploaded. Please upload a file using multipart/form-data."}),
+                orjson.dumps({"error": "No file uploaded. Please upload a file using multipart/form-data."}),
                 status_code=400,
                 mimetype="application/json"
             )
@@ -32,27 +69,19 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         file_data = req.files.get('file')
         if not file_data:
             return func.HttpResponse(
-                json.dumps({"error": "No file found with the key 'file'. Please ensure your form uses 'file' as the field name."}),
+                orjson.dumps({"error": "No file found with the key 'file'. Please ensure your form uses 'file' as the field name."}),
                 status_code=400,
                 mimetype="application/json"
             )
         
         file_name = file_data.filename
-        file_content = file_data.read()
-        
-        # Extract user info from form data
-        user_info = {}
-        metadata = {}
+        # Read the file once; the same bytes are uploaded and sent for analysis.
+        file_content, too_large = read_upload(file_data, _MAX_UPLOAD_MB)
+        if too_large is not None:
+            return too_large
         
-        # Process form fields
-        for key in req.form:
-            if key != 'file':
-                # User info fields
-                if key in ['owner', 'displayName', 'fullName', 'email', 'userId', 'restaurant']:
-                    user_info[key] = req.form[key]
-                # Metadata fields
-                else:
-                    metadata[key] = req.form[key]
+        # Extract user info from form data; everything else is metadata
+        user_info, metadata = parse_form(req)
         
         # Get Document Intelligence credentials
         endpoint = os.environ.get("DOCUMENT_INTELLIGENCE_ENDPOINT")
@@ -75,110 +104,39 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             error_message = f"Missing required configuration: {', '.join(missing_config)}"
             logging.error(error_message)
             return func.HttpResponse(
-                json.dumps({"error": error_message}),
+                orjson.dumps({"error": error_message}),
                 status_code=500,
                 mimetype="application/json"
             )
         
-        # Upload to blob storage
-        blob_client, blob_url = upload_to_blob_storage(
+        # One timestamp for the blob name and the database record
+        now = datetime.datetime.now(datetime.timezone.utc)
+        
+        # Upload to blob storage in the background
+        upload_future = storage.start_upload(
             blob_connection_string, 
             container_name, 
+            "receipt",
             file_name, 
             file_content,
-            metadata
+            metadata,
+            now
         )
         
+        # Analyze the document while the upload runs
+        result = analyze_document(endpoint, key, file_content)
+        
+        blob_client, blob_url = upload_future.result()
+        
         # Generate SAS URL for the blob
-        sas_url = generate_sas_url(
+        sas_url = storage.generate_sas_url(
             blob_connection_string,
             container_name,
             blob_client.blob_name
         )
         
-        # Analyze the document
-        result = analyze_document(endpoint, key, sas_url)
-        
         # Extract raw documents
-        raw_documents = None
-        if hasattr(result, 'documents') and result.documents:
-            # Print raw documents for debugging
-            print(f"Result documents: {result.documents}")
-            
-            # Extract raw document data as a list of dictionaries
-            raw_docs_list = []
-            for doc in result.documents:
-                doc_dict = {}
-                # Get doc_type and confidence if available
-                doc_dict["doc_type"] = doc.doc_type if hasattr(doc, "doc_type") else None
-                doc_dict["confidence"] = doc.confidence if hasattr(doc, "confidence") else None
-                
-                # Extract fields if available
-                if hasattr(doc, "fields"):
-                    fields_dict = {}
-                    for field_name, field in doc.fields.items():
-                        # Create field data dictionary
-                        field_dict = {
-                            "value_type": field.value_type if hasattr(field, "value_type") else None,
-                            "confidence": field.confidence if hasattr(field, "confidence") else None
-                        }
-                        
-                        # Extract value based on value_type
-                        if hasattr(field, "value_type"):
-                            if field.value_type == "string" and hasattr(field, "value_string"):
-                                field_dict["value"] = field.value_string
-                            elif field.value_type == "number" and hasattr(field, "value_number"):
-                                field_dict["value"] = field.value_number
-                            elif field.value_type == "integer" and hasattr(field, "value_integer"):
-                                field_dict["value"] = field.value_integer
-                            elif field.value_type == "date" and hasattr(field, "value_date"):
-                                field_dict["value"] = str(field.value_date)
-                            elif field.value_type == "time" and hasattr(field, "value_time"):
-                                field_dict["value"] = str(field.value_time)
-                            elif field.value_type == "phoneNumber" and hasattr(field, "value_phone_number"):
-                                field_dict["value"] = field.value_phone_number
-                            elif field.value_type == "selectionMark" and hasattr(field, "value_selection_mark"):
-                                field_dict["value"] = field.value_selection_mark
-                            elif field.value_type == "countryRegion" and hasattr(field, "value_country_region"):
-                                field_dict["value"] = field.value_country_region
-                            elif field.value_type == "array" and hasattr(field, "value_array"):
-                                # Handle arrays (like items in a receipt)
-                                items_list = []
-                                for item in field.value_array:
-                                    if hasattr(item, "value_type") and item.value_type == "object" and hasattr(item, "value_object"):
-                                        item_dict = {}
-                                        for item_field_name, item_field in item.value_object.items():
-                                            # Include field content and value
-                                            item_dict[item_field_name] = {
-                                                "content": item_field.content if hasattr(item_field, "content") else None
-                                            }
-                                            
-                                            # Get the typed value
-                                            if hasattr(item_field, "value_type"):
-                                                value_attr = f"value_{item_field.value_type}"
-                                                if hasattr(item_field, value_attr):
-                                                    value = getattr(item_field, value_attr)
-                                                    # Handle date objects
-                                                    if hasattr(value, "isoformat"):
-                                                        item_dict[item_field_name]["value"] = value.isoformat()
-                                                    else:
-                                                        item_dict[item_field_name]["value"] = value
-                                        
-                                        items_list.append(item_dict)
-                                
-                                field_dict["items"] = items_list
-                        
-                        # Add content when available
-                        if hasattr(field, "content"):
-                            field_dict["content"] = field.content
-                        
-                        fields_dict[field_name] = field_dict
-                    
-                    doc_dict["fields"] = fields_dict
-                
-                raw_docs_list.append(doc_dict)
-            
-            raw_documents = raw_docs_list
+        raw_documents = extract_raw_documents(result)
         
         # Save to database
         db_response = save_raw_documents_to_db(
@@ -187,13 +145,15 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             sas_url,
             user_info,
             metadata,
-            raw_documents
+            raw_documents,
+            now
         )
         
         # Determine receipt type for response
         receipt_type = "unknown"
         if raw_documents and len(raw_documents) > 0:
-            doc_type = raw_documents[0].get("doc_type")
+            # Receipt models report subtypes such as "receipt.retailMeal"
+            doc_type = (raw_documents[0].get("doc_type") or "").split(".")[0]
             if doc_type == "receipt":
                 receipt_type = "receipt"
                 # Check if it might be a restaurant bill
@@ -222,7 +182,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         }
         
         return func.HttpResponse(
-            json.dumps(response_data),
+            orjson.dumps(response_data, default=str),
             mimetype="application/json",
             status_code=200
         )
@@ -230,157 +190,190 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     except ValueError as ve:
         logging.error(f"Invalid request format: {str(ve)}")
         return func.HttpResponse(
-            json.dumps({"error": f"Invalid request format: {str(ve)}"}),
+            orjson.dumps({"error": f"Invalid request format: {str(ve)}"}),
             status_code=400,
             mimetype="application/json"
         )
     except Exception as e:
         logging.error(f"Unexpected error: {str(e)}")
         return func.HttpResponse(
-            json.dumps({"error": f"An unexpected error occurred: {str(e)}"}),
+            orjson.dumps({"error": f"An unexpected error occurred: {str(e)}"}),
             status_code=500,
             mimetype="application/json"
         )
 
-def upload_to_blob_storage(connection_string, container_name, file_name, file_content, metadata=None):
+def extract_raw_documents(result):
     """
-    Upload a file to Azure Blob Storage
+    Convert the documents in an analysis result to a list of plain dictionaries
     """
-    # Generate a unique file name with timestamp
-    timestamp = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    # Extract file extension
-    file_extension = os.path.splitext(file_name)[1] if '.' in file_name else ''
-    # Create a unique blob name
-    blob_name = f"receipt_{timestamp}{file_extension}"
-    
-    # Initialize the BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    
-    # Get the container client - create if it doesn't exist
-    container_client = blob_service_client.get_container_client(container_name)
-    if not container_client.exists():
-        container_client.create_container()
-    
-    # Get the blob client
-    blob_client = container_client.get_blob_client(blob_name)
+    documents = getattr(result, 'documents', None)
+    if not documents:
+        return None
     
-    # Upload the file
-    blob_client.upload_blob(file_content, overwrite=True, metadata=metadata)
-    
-    # Get the blob URL
-    blob_url = blob_client.url
+    # Extract raw document data as a list of dictionaries
+    raw_docs_list = []
+    for doc in documents:
+        # Get doc_type and confidence if available
+        doc_dict = {
+            "doc_type": getattr(doc, "doc_type", None),
+            "confidence": getattr(doc, "confidence", None)
+        }
+        
+        # Extract fields if available
+        fields = getattr(doc, "fields", None)
+        if fields is not None:
+            fields_dict = {}
+            for field_name, field in fields.items():
+                # Create field data dictionary
+                value_type = getattr(field, "type", None)
+                field_dict = {
+                    "value_type": value_type,
+                    "confidence": getattr(field, "confidence", None)
+                }
+                
+                # Extract value based on the field type
+                _extract_value(field, field_dict)
+                value_array = getattr(field, "value_array", None) if value_type == "array" else None
+                if value_array is not None:
+                    # Handle arrays (like items in a receipt)
+                    items_list = []
+                    append_item = items_list.append
+                    for item in value_array:
+                        value_object = getattr(item, "value_object", None)
+                        if value_object is not None and getattr(item, "type", None) == "object":
+                            item_dict = {}
+                            for item_field_name, item_field in value_object.items():
+                                # Include field content and value
+                                item_field_dict = {"content": getattr(item_field, "content", None)}
+                                _extract_value(item_field, item_field_dict)
+                                item_dict[item_field_name] = item_field_dict
+                            
+                            append_item(item_dict)
+                    
+                    field_dict["items"] = items_list
+                
+                # Add content when available
+                field_dict["content"] = getattr(field, "content", None)
+                
+                fields_dict[field_name] = field_dict
+            
+            doc_dict["fields"] = fields_dict
+        
+        raw_docs_list.append(doc_dict)
     
-    return blob_client, blob_url
+    return raw_docs_list
 
-def generate_sas_url(connection_string, container_name, blob_name):
+def _extract_value(field, field_dict):
     """
-    Generate a SAS URL for accessing the blob
+    Copy the typed value of a document field into field_dict["value"]
     """
-    # Parse the connection string to get account information
-    account_dict = {item.split('=', 1)[0]: item.split('=', 1)[1] for item in connection_string.split(';') if '=' in item}
-    account_name = account_dict.get('AccountName')
-    account_key = account_dict.get('AccountKey')
-    
-    if not account_name or not account_key:
-        raise ValueError("Could not extract account name and key from connection string")
-    
-    # Calculate token expiry time (1 hour from now)
-    expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
-    
-    # Create SAS token with read permission
-    sas_token = generate_blob_sas(
-        account_name=account_name,
-        account_key=account_key,
-        container_name=container_name,
-        blob_name=blob_name,
-        permission=BlobSasPermissions(read=True),
-        expiry=expiry
-    )
-    
-    # Construct the full SAS URL
-    sas_url = f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas_token}"
-    
-    return sas_url
+    value_attr = _VALUE_ATTR.get(getattr(field, "type", None))
+    if value_attr:
+        value = getattr(field, value_attr, None)
+        # Handle date and time objects, and SDK models such as CurrencyValue and AddressValue
+        if hasattr(value, "isoformat"):
+            value = value.isoformat()
+        elif hasattr(value, "as_dict"):
+            value = value.as_dict()
+        field_dict["value"] = value
 
-def analyze_document(endpoint, key, document_url):
+def analyze_document(endpoint, key, document_content):
     """
     Analyze a document using Azure Document Intelligence
     """
-    # Initialize the Document Intelligence Client
-    document_analysis_client = DocumentIntelligenceClient(
-        endpoint=endpoint, credential=AzureKeyCredential(key)
-    )
+    # Get the (cached) Document Intelligence Client
+    document_analysis_client = _get_document_client(endpoint, key)
     
     # Log available methods for debugging
-    methods = [method for method in dir(document_analysis_client) if method.startswith('begin_analyze')]
-    logging.info(f"Available analyze methods: {methods}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        methods = [method for method in dir(document_analysis_client) if method.startswith('begin_analyze')]
+        logging.debug(f"Available analyze methods: {methods}")
     
-    # Try to analyze with different model types based on availability, prioritizing receipt models
-    try:
-        # First try the prebuilt-receipt model (best for receipts)
-        analyze_request = AnalyzeDocumentRequest(url_source=document_url)
-        poller = document_analysis_client.begin_analyze_document(
-            "prebuilt-receipt", analyze_request
-        )
-        logging.info("Using prebuilt-receipt model")
-    except Exception as e1:
-        logging.warning(f"Receipt model failed: {str(e1)}")
+    analyze_request = AnalyzeDocumentRequest(bytes_source=document_content)
+    
+    # Try models in order of preference, skipping any this endpoint has said it doesn't have.
+    # Only a missing model moves on to the next one; throttling, service and content errors
+    # are raised so one bad request can't change the model used for later ones.
+    unavailable = _unavailable_models.setdefault(endpoint, set())
+    poller = None
+    for model_id in _ANALYZE_MODELS:
+        if model_id in unavailable:
+            continue
         try:
-            # Try the prebuilt-invoice model (good for restaurant bills)
-            analyze_request = AnalyzeDocumentRequest(url_source=document_url)
             poller = document_analysis_client.begin_analyze_document(
-                "prebuilt-invoice", analyze_request
-            )
-            logging.info("Using prebuilt-invoice model")
-        except Exception as e2:
-            logging.warning(f"Invoice model failed: {str(e2)}")
-            try:
-                # Try the prebuilt-document model
-                analyze_request = AnalyzeDocumentRequest(url_source=document_url)
-                poller = document_analysis_client.begin_analyze_document(
-                    "prebuilt-document", analyze_request
-                )
-                logging.info("Using prebuilt-document model")
-            except Exception as e3:
-                logging.warning(f"Document model failed: {str(e3)}")
-                # Fall back to layout model
-                analyze_request = AnalyzeDocumentRequest(url_source=document_url)
-                poller = document_analysis_client.begin_analyze_document(
-                    "prebuilt-layout", analyze_request
+                model_id,
+                analyze_request,
+                polling=_MinIntervalPolling(
+                    _POLLING_INTERVAL, path_format_arguments={"endpoint": endpoint}
                 )
-                logging.info("Using prebuilt-layout model")
+            )
+        except HttpResponseError as e:
+            if not _is_model_not_found(e):
+                raise
+            logging.warning(f"Model {model_id} is not available: {str(e)}")
+            unavailable.add(model_id)
+            continue
+        
+        logging.debug(f"Using {model_id} model")
+        break
+    
+    if poller is None:
+        raise RuntimeError(f"None of the analysis models are available: {', '.join(_ANALYZE_MODELS)}")
     
     # Wait for the analysis to complete and get the result
     result = poller.result()
     
     return result
 
-def save_raw_documents_to_db(blob_name, blob_url, sas_url, user_info, metadata, raw_documents):
+def _is_model_not_found(error):
+    """
+    Return True if the service rejected the request because the model does not exist
+    """
+    error_code = getattr(getattr(error, "error", None), "code", None)
+    return error.status_code == 404 or error_code == "ModelNotFound"
+
+class _MinIntervalPolling(LROBasePolling):
+    """
+    LRO polling that waits at least the configured interval between polls.
+    The service sends retry-after: 1, which would otherwise override polling_interval.
+    """
+    def _extract_delay(self):
+        return max(super()._extract_delay(), self._timeout)
+
+def _get_document_client(endpoint, key):
+    """
+    Return a cached DocumentIntelligenceClient for the endpoint and key
+    """
+    cache_key = (endpoint, key)
+    client = _di_client_cache.get(cache_key)
+    if client is None:
+        with _client_lock:
+            client = _di_client_cache.get(cache_key)
+            if client is None:
+                client = DocumentIntelligenceClient(
+                    endpoint=endpoint, credential=AzureKeyCredential(key), transport=TRANSPORT
+                )
+                _di_client_cache[cache_key] = client
+    return client
+
+def save_raw_documents_to_db(blob_name, blob_url, sas_url, user_info, metadata, raw_documents, timestamp=None):
     """
     Save the raw documents directly to the database without complex processing
     """
-    # Create timestamp
-    timestamp = datetime.datetime.utcnow()
+    if timestamp is None:
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
     
     # Generate a simple document key
     receipt_type = "receipt"
     if raw_documents and len(raw_documents) > 0 and raw_documents[0].get("doc_type"):
-        if raw_documents[0]["doc_type"] == "receipt":
+        doc_type = raw_documents[0]["doc_type"].split(".")[0]
+        if doc_type == "receipt":
             receipt_type = "receipt"
-        elif raw_documents[0]["doc_type"] == "invoice":
+        elif doc_type == "invoice":
             receipt_type = "invoice"
     
     # Get username if available
-    username = "unknown"
-    if user_info:
-        if user_info.get("displayName"):
-            username = user_info.get("displayName")
-        elif user_info.get("fullName"):
-            username = user_info.get("fullName")
-        elif user_info.get("owner"):
-            username = user_info.get("owner")
-        
-        username = convert_to_snake_case(username)
+    username = get_username(user_info)
     
     doc_key = f"{receipt_type}_{username}_{timestamp.strftime('%Y%m%d%H%M%S')}"
     
@@ -432,46 +425,23 @@ def save_raw_documents_to_db(blob_name, blob_url, sas_url, user_info, metadata,
             if "value" in date_info:
                 record["date"] = date_info["value"]
     
-    # Connect to the database and save
+    # Save to the database in the background; the id and key are already known
     try:
-        # Get Cosmos DB/MongoDB connection
-        load_dotenv()
-        cosmos_db_connection_string = os.environ.get("COSMOS_DB_CONNECTION_STRING")
-        database_name = os.environ.get("DATABASE_NAME", "ReceiptDatabase")
-        container_name = os.environ.get("CONTAINER_NAME", "Receipts")
-        
-        # Connect to database
-        client = MongoClient(
-            cosmos_db_connection_string,
-            socketTimeoutMS=60000,
-            connectTimeoutMS=60000
+        # Get the (cached) collection
+        collection = database.get_collection(
+            os.environ.get("DATABASE_NAME", "ReceiptDatabase"),
+            os.environ.get("CONTAINER_NAME", "Receipts")
         )
         
-        # Get database and collection
-        database = client[database_name]
-        collection = database[container_name]
-        
-        # Insert document
-        result = collection.insert_one(record)
+        # Insert document off the request path
+        database.insert_in_background(collection, [record])
         
         return {
-            "id": str(result.inserted_id),
+            "id": record["_id"],
             "document_key": doc_key,
-            "status": "saved"
+            "status": "queued"
         }
     
     except Exception as e:
         logging.error(f"Error saving to database: {str(e)}")
         raise
-
-def convert_to_snake_case(text):
-    """
-    Convert a display name or text to snake_case format
-    Example: "John Doe" -> "john_doe"
-    """
-    # Replace spaces and special characters with underscores
-    s1 = re.sub(r'[^\w\s]', '_', str(text))
-    # Replace one or more spaces with a single underscore
-    s2 = re.sub(r'\s+', '_', s1)
-    # Convert to lowercase
-    return s2.lower()
\ No newline at end of file
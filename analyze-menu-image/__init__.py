@@ -2,39 +2,117 @@
 import logging
 import azure.functions as func
 import os
-import json
+import orjson
 import re
 import datetime
 import uuid
+import hashlib
+import threading
+import time
+import redis
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.vision.imageanalysis import ImageAnalysisClient
 from azure.ai.vision.imageanalysis.models import VisualFeatures
 from openai import AzureOpenAI
-from azure.storage.blob import BlobServiceClient, BlobSasPermissions, generate_blob_sas
-from pymongo import MongoClient
 from dotenv import load_dotenv
+from shared_code import database, storage
+from shared_code.transport import TRANSPORT
+from shared_code.utils import check_content_length, convert_to_snake_case, get_username, parse_form, read_upload
 
 # Load environment variables
 load_dotenv()
 
+# Service configuration, read once per worker
+_VISION_ENDPOINT = os.environ.get("VISION_ENDPOINT")
+_VISION_KEY = os.environ.get("VISION_KEY")
+_OPENAI_ENDPOINT = os.environ.get("OPENAI_ENDPOINT")
+_OPENAI_KEY = os.environ.get("OPENAI_KEY")
+_OPENAI_DEPLOYMENT = os.environ.get("OPENAI_DEPLOYMENT", "gpt-35-turbo")
+_BLOB_CONNECTION_STRING = os.environ.get("BLOB_STORAGE_CONNECTION_STRING")
+_BLOB_CONTAINER_NAME = os.environ.get("BLOB_CONTAINER_NAME", "menu-images")
+_DATABASE_NAME = os.environ.get("DATABASE_NAME", "MenuDatabase")
+_COLLECTION_NAME = os.environ.get("CONTAINER_NAME", "MenuAnalysis")
+_REDIS_URL = os.environ.get("REDIS_URL")
+
+# Required settings that are not configured; requests are refused until they are
+_MISSING_CONFIG = [
+    name for name, value in (
+        ("VISION_ENDPOINT", _VISION_ENDPOINT),
+        ("VISION_KEY", _VISION_KEY),
+        ("OPENAI_ENDPOINT", _OPENAI_ENDPOINT),
+        ("OPENAI_KEY", _OPENAI_KEY),
+        ("BLOB_STORAGE_CONNECTION_STRING", _BLOB_CONNECTION_STRING),
+    ) if not value
+]
+if _MISSING_CONFIG:
+    logging.error(f"Missing required configuration: {', '.join(_MISSING_CONFIG)}")
+
+# Largest accepted upload
+_MAX_UPLOAD_MB = int(os.getenv("MENU_MAX_UPLOAD_MB", "20"))
+
+# Upper bound on the dietary analysis reply. The JSON schema in the system prompt fits well
+# within it, and a tighter bound keeps generation time down.
+_OPENAI_MAX_TOKENS = int(os.environ.get("OPENAI_MAX_TOKENS", "400"))
+
+# SDK clients are reused across invocations so requests share connections
+_client_lock = threading.Lock()
+_vision_client_cache = {}
+_openai_client_cache = {}
+
+# Optional Redis cache of analysis results, keyed by image content and dietary profile
+_ANALYSIS_CACHE_TTL = int(os.environ.get("ANALYSIS_CACHE_TTL", "86400"))
+_redis_client = None
+# After a Redis error the cache is skipped for this many seconds rather than timing out on every request
+_REDIS_RETRY_AFTER = 30
+_redis_unavailable_until = 0.0
+
+# Tag name fragments that mark a Vision tag as food related
+_FOOD_CATEGORIES = frozenset(["food", "cuisine", "dish", "meal", "ingredient", "dessert", "fruit", "vegetable", "meat"])
+
+# Patterns used to pull a dish name out of the caption or menu text
+_PHOTO_OF_RE = re.compile(r'(a|an) (photo|picture|image) of')
+_PLATE_OF_RE = re.compile(r'a plate of')
+_DISH_NAME_RE = re.compile(r'^[A-Z][a-zA-Z\s]+$')
+
+# Fixed instructions for the dietary analysis. Keeping them identical at the start of every
+# request lets the provider's prompt cache reuse the prefix.
+_DIETARY_SYSTEM_PROMPT = """You are a nutrition expert analyzing a food item from a menu and providing detailed food analysis in JSON format.
+
+The user message gives the dish the food item appears to be, additional food tags identified in the image, text extracted from the menu, and any dietary restrictions and health conditions to take into account.
+
+Please provide:
+1. A brief description of this dish
+2. Likely ingredients (list the main ingredients)
+3. Estimated calorie count (provide a range)
+4. Nutritional information (protein, carbs, fat estimates)
+5. Dietary considerations (is it vegetarian, vegan, gluten-free, etc.)
+6. Health considerations (how this dish might affect someone with the mentioned health conditions)
+7. Recommendations (whether to eat it, portion control advice, etc.)
+
+Format your response as JSON with the following structure:
+{"description": "...", "ingredients": ["...", "..."], "calories": "...", "nutrition": {"protein": "...", "carbs": "...", "fat": "..."}, "dietary_info": "...", "health_warnings": "...", "recommendations": "..."}"""
+
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function for menu image analysis.')
     
     try:
-        # Try to import dotenv and load from .env file
-        try:
-            from dotenv import load_dotenv
-            load_dotenv()
-            logging.info("Loaded environment variables from .env file")
-        except ImportError:
-            logging.info("python-dotenv not installed, using environment variables directly")
-        except Exception as e:
-            logging.warning(f"Could not load .env file: {str(e)}")
+        # Refuse requests up front if the function is not configured
+        if _MISSING_CONFIG:
+            return func.HttpResponse(
+                orjson.dumps({"error": f"Missing required configuration: {', '.join(_MISSING_CONFIG)}"}),
+                status_code=500,
+                mimetype="application/json"
+            )
+        
+        # Reject oversized uploads before the multipart body is parsed
+        too_large = check_content_length(req, _MAX_UPLOAD_MB)
+        if too_large is not None:
+            return too_large
         
         # Check if the request contains a file upload
         if not req.files:
             return func.HttpResponse(
-                json.dumps({"error": "No file uploaded. Please upload a file using multipart/form-data."}),
+                orjson.dumps({"error": "No file uploaded. Please upload a file using multipart/form-data."}),
                 status_code=400,
                 mimetype="application/json"
             )
@@ -43,105 +121,75 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         file_data = req.files.get('file')
         if not file_data:
             return func.HttpResponse(
-                json.dumps({"error": "No file found with the key 'file'. Please ensure your form uses 'file' as the field name."}),
+                orjson.dumps({"error": "No file found with the key 'file'. Please ensure your form uses 'file' as the field name."}),
                 status_code=400,
                 mimetype="application/json"
             )
         
         file_name = file_data.filename
-        file_content = file_data.read()
-        
-        # Extract user info and dietary preferences from form data
-        user_info = {}
-        metadata = {}
-        dietary_restrictions = []
-        health_conditions = []
-        
-        # Process form fields
-        for key in req.form:
-            if key != 'file':
-                # User info fields
-                if key in ['owner', 'displayName', 'fullName', 'email', 'userId', 'restaurant']:
-                    user_info[key] = req.form[key]
-                # Dietary restrictions
-                elif key == 'dietary_restrictions':
-                    dietary_restrictions = req.form[key].split(',')
-                # Health conditions
-                elif key == 'health_conditions':
-                    health_conditions = req.form[key].split(',')
-                # Metadata fields
-                else:
-                    metadata[key] = req.form[key]
-        
-        # Get Computer Vision credentials
-        vision_endpoint = os.environ.get("VISION_ENDPOINT")
-        vision_key = os.environ.get("VISION_KEY")
-        
-        # Get OpenAI credentials
-        openai_endpoint = os.environ.get("OPENAI_ENDPOINT") 
-        openai_key = os.environ.get("OPENAI_KEY")
-        openai_deployment = os.environ.get("OPENAI_DEPLOYMENT", "gpt-35-turbo")
-        
-        # Get Blob Storage credentials
-        blob_connection_string = os.environ.get("BLOB_STORAGE_CONNECTION_STRING")
-        container_name = os.environ.get("BLOB_CONTAINER_NAME", "menu-images")
-        
-        # Check for missing required configuration
-        missing_config = []
-        if not vision_endpoint:
-            missing_config.append("VISION_ENDPOINT")
-        if not vision_key:
-            missing_config.append("VISION_KEY")
-        if not openai_endpoint:
-            missing_config.append("OPENAI_ENDPOINT")
-        if not openai_key:
-            missing_config.append("OPENAI_KEY")
-        if not blob_connection_string:
-            missing_config.append("BLOB_STORAGE_CONNECTION_STRING")
-        
-        if missing_config:
-            error_message = f"Missing required configuration: {', '.join(missing_config)}"
-            logging.error(error_message)
-            return func.HttpResponse(
-                json.dumps({"error": error_message}),
-                status_code=500,
-                mimetype="application/json"
-            )
-        
-        # Upload to blob storage
-        blob_client, blob_url = upload_to_blob_storage(
-            blob_connection_string, 
-            container_name, 
+        # Read the image once; the upload, the cache key and Vision all share this one bytes object.
+        file_content, too_large = read_upload(file_data, _MAX_UPLOAD_MB)
+        if too_large is not None:
+            return too_large
+        
+        # Extract user info and dietary preferences from form data; everything else is metadata
+        user_info, metadata = parse_form(req)
+        # Dietary restrictions and health conditions are comma-separated lists
+        dietary_restrictions = metadata.pop('dietary_restrictions').split(',') if 'dietary_restrictions' in metadata else []
+        health_conditions = metadata.pop('health_conditions').split(',') if 'health_conditions' in metadata else []
+        
+        # One timestamp for the blob name, the analysis and the database record
+        now = datetime.datetime.now(datetime.timezone.utc)
+        
+        # Upload to blob storage in the background; nothing below needs the blob until it is saved
+        upload_future = storage.start_upload(
+            _BLOB_CONNECTION_STRING, 
+            _BLOB_CONTAINER_NAME, 
+            "menu",
             file_name, 
             file_content,
-            metadata
+            metadata,
+            now,
+            max_concurrency=4
         )
         
-        # Generate SAS URL for the blob
-        sas_url = generate_sas_url(
-            blob_connection_string,
-            container_name,
-            blob_client.blob_name
-        )
+        # Re-uploads of the same image with the same dietary profile reuse the earlier analysis
+        cache_key = get_analysis_cache_key(file_content, dietary_restrictions, health_conditions)
+        analysis_results = get_cached_analysis(cache_key)
+        
+        if analysis_results is None:
+            # Step 1: Analyze the menu image with Computer Vision
+            vision_results = analyze_menu_image(_VISION_ENDPOINT, _VISION_KEY, file_content)
+            
+            # Step 2: Get dish analysis and dietary advice from OpenAI
+            openai_results = get_dietary_advice(
+                _OPENAI_ENDPOINT, 
+                _OPENAI_KEY, 
+                _OPENAI_DEPLOYMENT,
+                vision_results, 
+                dietary_restrictions, 
+                health_conditions,
+                now
+            )
+            
+            # Combine all results
+            analysis_results = {
+                "vision_analysis": vision_results,
+                "dietary_analysis": openai_results
+            }
+            cache_analysis(cache_key, analysis_results)
         
-        # Step 1: Analyze the menu image with Computer Vision
-        vision_results = analyze_menu_image(vision_endpoint, vision_key, file_content)
+        vision_results = analysis_results["vision_analysis"]
+        openai_results = analysis_results["dietary_analysis"]
         
-        # Step 2: Get dish analysis and dietary advice from OpenAI
-        openai_results = get_dietary_advice(
-            openai_endpoint, 
-            openai_key, 
-            openai_deployment,
-            vision_results, 
-            dietary_restrictions, 
-            health_conditions
-        )
+        blob_client, blob_url = upload_future.result()
         
-        # Combine all results
-        analysis_results = {
-            "vision_analysis": vision_results,
-            "dietary_analysis": openai_results
-        }
+        # Generate SAS URL for the blob
+        sas_url = storage.generate_sas_url(
+            _BLOB_CONNECTION_STRING,
+            _BLOB_CONTAINER_NAME,
+            blob_client.blob_name
+        )
         
         # Save to database
         db_response = save_menu_analysis_to_db(
@@ -152,7 +200,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             metadata,
             dietary_restrictions,
             health_conditions,
-            analysis_results
+            analysis_results,
+            now
         )
         
         # Prepare the response
@@ -167,7 +216,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         }
         
         return func.HttpResponse(
-            json.dumps(response_data),
+            orjson.dumps(response_data),
             mimetype="application/json",
             status_code=200
         )
@@ -175,87 +224,92 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     except ValueError as ve:
         logging.error(f"Invalid request format: {str(ve)}")
         return func.HttpResponse(
-            json.dumps({"error": f"Invalid request format: {str(ve)}"}),
+            orjson.dumps({"error": f"Invalid request format: {str(ve)}"}),
             status_code=400,
             mimetype="application/json"
         )
     except Exception as e:
         logging.error(f"Unexpected error: {str(e)}")
         return func.HttpResponse(
-            json.dumps({"error": f"An unexpected error occurred: {str(e)}"}),
+            orjson.dumps({"error": f"An unexpected error occurred: {str(e)}"}),
             status_code=500,
             mimetype="application/json"
         )
 
-def upload_to_blob_storage(connection_string, container_name, file_name, file_content, metadata=None):
+def get_analysis_cache_key(image_data, dietary_restrictions, health_conditions):
     """
-    Upload a file to Azure Blob Storage
+    Build the analysis cache key from the image content and the dietary profile
     """
-    # Generate a unique file name with timestamp
-    timestamp = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    # Extract file extension
-    file_extension = os.path.splitext(file_name)[1] if '.' in file_name else ''
-    # Create a unique blob name
-    blob_name = f"menu_{timestamp}{file_extension}"
-    
-    # Initialize the BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    
-    # Get the container client - create if it doesn't exist
-    container_client = blob_service_client.get_container_client(container_name)
-    if not container_client.exists():
-        container_client.create_container()
-    
-    # Get the blob client
-    blob_client = container_client.get_blob_client(blob_name)
-    
-    # Upload the file
-    blob_client.upload_blob(file_content, overwrite=True, metadata=metadata)
-    
-    # Get the blob URL
-    blob_url = blob_client.url
-    
-    return blob_client, blob_url
+    image_hash = hashlib.sha256(image_data).hexdigest()
+    profile = _normalize_profile(dietary_restrictions) + '|' + _normalize_profile(health_conditions)
+    profile_hash = hashlib.sha256(profile.encode()).hexdigest()
+    return f"menu:{image_hash}:{profile_hash}"
 
-def generate_sas_url(connection_string, container_name, blob_name):
+def _normalize_profile(entries):
     """
-    Generate a SAS URL for accessing the blob
+    Turn a list of restrictions or conditions into a stable, order-independent string
     """
-    # Parse the connection string to get account information
-    account_dict = {item.split('=', 1)[0]: item.split('=', 1)[1] for item in connection_string.split(';') if '=' in item}
-    account_name = account_dict.get('AccountName')
-    account_key = account_dict.get('AccountKey')
-    
-    if not account_name or not account_key:
-        raise ValueError("Could not extract account name and key from connection string")
-    
-    # Calculate token expiry time (1 hour from now)
-    expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    return ','.join(sorted(entry.strip().lower() for entry in entries if entry.strip()))
+
+def get_cached_analysis(cache_key):
+    """
+    Return cached analysis results for the key, or None on a miss or when caching is off
+    """
+    client = _get_redis_client()
+    if client is None:
+        return None
     
-    # Create SAS token with read permission
-    sas_token = generate_blob_sas(
-        account_name=account_name,
-        account_key=account_key,
-        container_name=container_name,
-        blob_name=blob_name,
-        permission=BlobSasPermissions(read=True),
-        expiry=expiry
-    )
+    try:
+        cached = client.get(cache_key)
+    except Exception as e:
+        logging.warning(f"Could not read analysis cache: {str(e)}")
+        _mark_redis_unavailable()
+        return None
     
-    # Construct the full SAS URL
-    sas_url = f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas_token}"
+    return orjson.loads(cached) if cached else None
+
+def cache_analysis(cache_key, analysis_results):
+    """
+    Cache successful analysis results; failed analyses are retried on the next upload
+    """
+    client = _get_redis_client()
+    if client is None:
+        return
+    if "error" in analysis_results["vision_analysis"] or "error" in analysis_results["dietary_analysis"]:
+        return
     
-    return sas_url
+    try:
+        client.set(cache_key, orjson.dumps(analysis_results), ex=_ANALYSIS_CACHE_TTL)
+    except Exception as e:
+        logging.warning(f"Could not write analysis cache: {str(e)}")
+        _mark_redis_unavailable()
+
+def _get_redis_client():
+    """
+    Return the Redis client for the analysis cache, or None if REDIS_URL is not configured
+    or Redis failed within the last _REDIS_RETRY_AFTER seconds
+    """
+    global _redis_client
+    if time.monotonic() < _redis_unavailable_until:
+        return None
+    if _redis_client is None:
+        if _REDIS_URL:
+            _redis_client = redis.Redis.from_url(_REDIS_URL, socket_timeout=2, socket_connect_timeout=2)
+    return _redis_client
+
+def _mark_redis_unavailable():
+    """
+    Skip the analysis cache for a while after a Redis error
+    """
+    global _redis_unavailable_until
+    _redis_unavailable_until = time.monotonic() + _REDIS_RETRY_AFTER
 
 def analyze_menu_image(vision_endpoint, vision_key, image_data):
     """
     Analyze a menu image using Azure AI Vision Image Analysis 4.0
     """
-    # Initialize the Vision client
-    client = ImageAnalysisClient(
-        endpoint=vision_endpoint,
-        credential=AzureKeyCredential(vision_key)
-    )
+    # Get the (cached) Vision client
+    client = _get_vision_client(vision_endpoint, vision_key)
     
     # Define visual features to analyze
     visual_features = [
@@ -279,10 +333,10 @@ def analyze_menu_image(vision_endpoint, vision_key, image_data):
         menu_text = ""
         
         # Extract tags related to food
-        food_related_categories = ["food", "cuisine", "dish", "meal", "ingredient", "dessert", "fruit", "vegetable", "meat"]
         if result.tags:
             for tag in result.tags.list:
-                if any(category in tag.name.lower() for category in food_related_categories):
+                tag_name = tag.name.lower()
+                if any(category in tag_name for category in _FOOD_CATEGORIES):
                     food_tags.append({"name": tag.name, "confidence": tag.confidence})
         
         # Sort food tags by confidence
@@ -295,8 +349,8 @@ def analyze_menu_image(vision_endpoint, vision_key, image_data):
             # Extract the main subject from the caption
             caption_text = result.caption.text.lower()
             # Remove common phrases like "a photo of", "an image of", etc.
-            caption_text = re.sub(r'(a|an) (photo|picture|image) of', '', caption_text).strip()
-            caption_text = re.sub(r'a plate of', '', caption_text).strip()
+            caption_text = _PHOTO_OF_RE.sub('', caption_text).strip()
+            caption_text = _PLATE_OF_RE.sub('', caption_text).strip()
             dish_name = caption_text
         
         # Extract text from the image (menu description)
@@ -310,7 +364,7 @@ def analyze_menu_image(vision_endpoint, vision_key, image_data):
             # Look for capitalized text that might be a dish name
             lines = menu_text.split('\n')
             for line in lines:
-                if re.match(r'^[A-Z][a-zA-Z\s]+$', line.strip()):
+                if _DISH_NAME_RE.match(line.strip()):
                     dish_name = line.strip()
                     break
         
@@ -330,16 +384,15 @@ def analyze_menu_image(vision_endpoint, vision_key, image_data):
         logging.error(f"Error analyzing image with Vision: {str(e)}")
         return {"error": str(e)}
 
-def get_dietary_advice(openai_endpoint, openai_key, openai_deployment, vision_results, dietary_restrictions, health_conditions):
+def get_dietary_advice(openai_endpoint, openai_key, openai_deployment, vision_results, dietary_restrictions, health_conditions, timestamp=None):
     """
     Get dietary advice using Azure OpenAI
     """
-    # Initialize the OpenAI client
-    openai_client = AzureOpenAI(
-        azure_endpoint=openai_endpoint,
-        api_key=openai_key,
-        api_version="2023-05-15"
-    )
+    if timestamp is None:
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+    
+    # Get the (cached) OpenAI client
+    openai_client = _get_openai_client(openai_endpoint, openai_key)
     
     # Prepare the prompt
     dish_name = vision_results.get("dish_name", "Unknown dish")
@@ -347,63 +400,53 @@ def get_dietary_advice(openai_endpoint, openai_key, openai_deployment, vision_re
     food_tags_text = ", ".join([tag["name"] for tag in food_tags[:5]])
     menu_text = vision_results.get("menu_text", "")
     
-    # Create a list of dietary restrictions if any
-    restrictions_text = ""
-    if dietary_restrictions:
-        restrictions_text = "Dietary restrictions: " + ", ".join(dietary_restrictions)
-        
-    # Create a list of health conditions if any
-    conditions_text = ""
-    if health_conditions:
-        conditions_text = "Health conditions: " + ", ".join(health_conditions)
+    restrictions_text = ", ".join(dietary_restrictions) if dietary_restrictions else "none"
+    conditions_text = ", ".join(health_conditions) if health_conditions else "none"
     
-    # Create the prompt for OpenAI
-    prompt = f"""
-    You are a nutrition expert analyzing a food item from a menu.
-
-    The food item appears to be: {dish_name}
-
-    Additional food tags identified: {food_tags_text}
-
-    Text extracted from the menu:
-    {menu_text}
-
-    {restrictions_text}
-    {conditions_text}
-
-    Please provide:
-    1. A brief description of this dish
-    2. Likely ingredients (list the main ingredients)
-    3. Estimated calorie count (provide a range)
-    4. Nutritional information (protein, carbs, fat estimates)
-    5. Dietary considerations (is it vegetarian, vegan, gluten-free, etc.)
-    6. Health considerations (how this dish might affect someone with the mentioned health conditions)
-    7. Recommendations (whether to eat it, portion control advice, etc.)
-
-    Format your response as JSON with the following structure:
-    {{"description": "...", "ingredients": ["...", "..."], "calories": "...", "nutrition": {{"protein": "...", "carbs": "...", "fat": "..."}}, "dietary_info": "...", "health_warnings": "...", "recommendations": "..."}}
-    """
+    # Only the dish-specific details go in the user message; the fixed instructions
+    # stay in the system prompt so every request shares the same prompt prefix
+    prompt = f"""Dish: {dish_name}
+Tags: {food_tags_text}
+Menu text:
+{menu_text}
+Dietary restrictions: {restrictions_text}
+Health conditions: {conditions_text}"""
     
     try:
         # Call OpenAI
         response = openai_client.chat.completions.create(
             model=openai_deployment,
             messages=[
-                {"role": "system", "content": "You are a nutrition expert providing detailed food analysis in JSON format."},
+                {"role": "system", "content": _DIETARY_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.7,
-            max_tokens=800,
-            response_format={"type": "json_object"}
+            max_tokens=_OPENAI_MAX_TOKENS,
+            response_format={"type": "json_object"},
+            stream=True
         )
         
-        # Extract and parse the JSON response
-        content = response.choices[0].message.content
-        analysis_result = json.loads(content)
+        # Collect the streamed reply; some chunks (e.g. content filter results) carry no choices
+        content_parts = []
+        finish_reason = None
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta and choice.delta.content:
+                content_parts.append(choice.delta.content)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+        
+        if finish_reason == "length":
+            raise ValueError(f"OpenAI response was cut off at {_OPENAI_MAX_TOKENS} tokens")
+        
+        # Parse the JSON response
+        analysis_result = orjson.loads("".join(content_parts))
         
         # Add some metadata
         analysis_result["dish_analyzed"] = dish_name
-        analysis_result["analysis_timestamp"] = datetime.datetime.utcnow().isoformat()
+        analysis_result["analysis_timestamp"] = timestamp.isoformat()
         
         return analysis_result
         
@@ -412,16 +455,50 @@ def get_dietary_advice(openai_endpoint, openai_key, openai_deployment, vision_re
         return {
             "error": str(e),
             "dish_analyzed": dish_name,
-            "analysis_timestamp": datetime.datetime.utcnow().isoformat()
+            "analysis_timestamp": timestamp.isoformat()
         }
 
+def _get_vision_client(endpoint, key):
+    """
+    Return a cached ImageAnalysisClient for the endpoint and key
+    """
+    cache_key = (endpoint, key)
+    client = _vision_client_cache.get(cache_key)
+    if client is None:
+        with _client_lock:
+            client = _vision_client_cache.get(cache_key)
+            if client is None:
+                client = ImageAnalysisClient(
+                    endpoint=endpoint, credential=AzureKeyCredential(key), transport=TRANSPORT
+                )
+                _vision_client_cache[cache_key] = client
+    return client
+
+def _get_openai_client(endpoint, key):
+    """
+    Return a cached AzureOpenAI client for the endpoint and key
+    """
+    cache_key = (endpoint, key)
+    client = _openai_client_cache.get(cache_key)
+    if client is None:
+        with _client_lock:
+            client = _openai_client_cache.get(cache_key)
+            if client is None:
+                client = AzureOpenAI(
+                    azure_endpoint=endpoint,
+                    api_key=key,
+                    api_version="2023-05-15"
+                )
+                _openai_client_cache[cache_key] = client
+    return client
+
 def save_menu_analysis_to_db(blob_name, blob_url, sas_url, user_info, metadata, 
-                             dietary_restrictions, health_conditions, analysis_results):
+                             dietary_restrictions, health_conditions, analysis_results, timestamp=None):
     """
     Save the menu analysis to the database
     """
-    # Create timestamp
-    timestamp = datetime.datetime.utcnow()
+    if timestamp is None:
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
     
     # Get dish name from analysis
     dish_name = "unknown_dish"
@@ -430,16 +507,7 @@ def save_menu_analysis_to_db(blob_name, blob_url, sas_url, user_info, metadata,
     dish_name = convert_to_snake_case(dish_name)
     
     # Get username if available
-    username = "unknown"
-    if user_info:
-        if user_info.get("displayName"):
-            username = user_info.get("displayName")
-        elif user_info.get("fullName"):
-            username = user_info.get("fullName")
-        elif user_info.get("owner"):
-            username = user_info.get("owner")
-        
-        username = convert_to_snake_case(username)
+    username = get_username(user_info)
     
     # Create a document key
     doc_key = f"menu_{dish_name}_{username}_{timestamp.strftime('%Y%m%d%H%M%S')}"
@@ -474,29 +542,19 @@ def save_menu_analysis_to_db(blob_name, blob_url, sas_url, user_info, metadata,
     
     # Connect to the database and save
     try:
-        # Get Cosmos DB/MongoDB connection
-        cosmos_db_connection_string = os.environ.get("COSMOS_DB_CONNECTION_STRING")
-        database_name = os.environ.get("DATABASE_NAME", "MenuDatabase")
-        container_name = os.environ.get("CONTAINER_NAME", "MenuAnalysis")
-        
-        # Connect to database
-        client = MongoClient(
-            cosmos_db_connection_string,
-            socketTimeoutMS=60000,
-            connectTimeoutMS=60000
+        # Get the (cached) collection
+        collection = database.get_collection(
+            _DATABASE_NAME,
+            _COLLECTION_NAME
         )
         
-        # Get database and collection
-        database = client[database_name]
-        collection = database[container_name]
-        
-        # Insert document
-        result = collection.insert_one(record)
+        # Insert document off the request path, batched with other pending writes
+        database.insert_in_background(collection, [record])
         
         return {
-            "id": str(result.inserted_id),
+            "id": record["_id"],
             "document_key": doc_key,
-            "status": "saved"
+            "status": "queued"
         }
     
     except Exception as e:
@@ -508,15 +566,3 @@ def save_menu_analysis_to_db(blob_name, blob_url, sas_url, user_info, metadata,
             "status": "analysis-completed-but-not-saved",
             "error": str(e)
         }
-
-def convert_to_snake_case(text):
-    """
-    Convert a display name or text to snake_case format
-    Example: "John Doe" -> "john_doe"
-    """
-    # Replace spaces and special characters with underscores
-    s1 = re.sub(r'[^\w\s]', '_', str(text))
-    # Replace one or more spaces with a single underscore
-    s2 = re.sub(r'\s+', '_', s1)
-    # Convert to lowercase
-    return s2.lower()
\ No newline at end of file
@@ -1,14 +1,21 @@
 import logging
 import azure.functions as func
-import requests
-import json
+import httpx
+import orjson
 import os
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+# Shared client so Language service calls reuse keep-alive (HTTP/2) connections across invocations
+_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
+
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
     
     try:
@@ -36,7 +43,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     
     # Communicate with the Language service
     try:
-        response = query_language_service(subscription_key, message)
+        response = await query_language_service(subscription_key, message)
         
         # Check if we got a default answer (indicated by confidenceScore of 0.0)
         is_default_answer = False
@@ -44,7 +51,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             is_default_answer = True
             
         return func.HttpResponse(
-            json.dumps({
+            orjson.dumps({
                 "response": response,
                 "is_default_answer": is_default_answer,
                 "answer_text": response.get("answers", [{}])[0].get("answer", "No answer available")
@@ -58,7 +65,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             status_code=500
         )
 
-def query_language_service(subscription_key, question):
+async def query_language_service(subscription_key, question):
     # Language service endpoint
     url = "https://promptmenuqna.cognitiveservices.azure.com/language/:query-knowledgebases"
     
@@ -89,13 +96,13 @@ def query_language_service(subscription_key, question):
     }
     
     # Send request to Language service
-    response = requests.post(url, headers=headers, params=params, json=payload)
+    response = await _client.post(url, headers=headers, params=params, content=orjson.dumps(payload))
     
     if response.status_code != 200:
         raise Exception(f"Failed to query Language service: {response.text}")
     
     # Process the response
-    response_data = response.json()
+    response_data = orjson.loads(response.content)
     
     # Return the full response for more detailed processing if needed
     # This allows the client to handle default answers differently if desired
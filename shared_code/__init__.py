@@ -0,0 +1,3 @@
+# __init__.py
+# Helpers shared by the HTTP functions. Keeping them in one module means the
+# cached SDK and database clients are shared by every function in the worker.
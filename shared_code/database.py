@@ -0,0 +1,135 @@
+# database.py
+import logging
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bson
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+
+# MongoClient is thread-safe and pools connections, so one client serves every invocation
+_client_lock = threading.Lock()
+_mongo_client_cache = {}
+
+# Background writes are batched: a writer thread collects up to _BATCH_SIZE records, or
+# whatever has queued up within _BATCH_WINDOW seconds of the first, and hands each
+# collection's share to the insert pool so retries and slow inserts don't hold up draining.
+# At most _MAX_PENDING_WRITES records wait in the queue; beyond that new records are dropped
+# and logged. Writes still queued when the worker shuts down are lost.
+_BATCH_SIZE = 100
+_BATCH_WINDOW = 0.5
+_MAX_PENDING_WRITES = 5000
+_MAX_INFLIGHT_BATCHES = 8
+_DB_WRITE_ATTEMPTS = 3
+_DB_SOCKET_TIMEOUT_MS = 10000
+_WRITE_CONCERN = WriteConcern(w=1, j=False)
+_pending_writes = queue.Queue(maxsize=_MAX_PENDING_WRITES)
+_insert_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db-insert")
+_inflight_batches = threading.BoundedSemaphore(_MAX_INFLIGHT_BATCHES)
+_writer_thread = None
+
+# Records are encoded by the BSON C extension; the pure Python fallback is several times slower
+if not bson.has_c():
+    logging.warning("bson C extension is not available; database records will be encoded in pure Python")
+
+def get_collection(database_name, container_name):
+    """
+    Return a Cosmos DB/MongoDB collection, connecting on first use
+    """
+    return _get_mongo_client(os.environ.get("COSMOS_DB_CONNECTION_STRING"))[database_name][container_name]
+
+def _get_mongo_client(connection_string):
+    """
+    Return a cached MongoClient for the connection string
+    """
+    client = _mongo_client_cache.get(connection_string)
+    if client is None:
+        with _client_lock:
+            client = _mongo_client_cache.get(connection_string)
+            if client is None:
+                client = MongoClient(
+                    connection_string,
+                    socketTimeoutMS=_DB_SOCKET_TIMEOUT_MS,
+                    connectTimeoutMS=60000,
+                    maxPoolSize=50,
+                    appname="promptmenu-fn"
+                )
+                _mongo_client_cache[connection_string] = client
+    return client
+
+def insert_in_background(collection, records):
+    """
+    Queue records for insertion off the request path
+    """
+    _start_writer()
+    for record in records:
+        try:
+            _pending_writes.put_nowait((collection, record))
+        except queue.Full:
+            logging.error(f"Database write queue is full; dropping record {record.get('_id')} for {collection.full_name}")
+
+def _start_writer():
+    """
+    Start the background batch writer thread on first use
+    """
+    global _writer_thread
+    if _writer_thread is None:
+        with _client_lock:
+            if _writer_thread is None:
+                _writer_thread = threading.Thread(target=_write_batches, name="db-batch-writer", daemon=True)
+                _writer_thread.start()
+
+def _write_batches():
+    """
+    Drain queued writes in batches, one insert_many per collection per batch
+    """
+    while True:
+        batch = [_pending_writes.get()]
+        deadline = time.monotonic() + _BATCH_WINDOW
+        while len(batch) < _BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_pending_writes.get(timeout=timeout))
+            except queue.Empty:
+                break
+        
+        records_by_collection = {}
+        for collection, record in batch:
+            records_by_collection.setdefault(collection.full_name, (collection, []))[1].append(record)
+        
+        for collection, records in records_by_collection.values():
+            # Wait for a free slot so stalled inserts back up into the bounded queue
+            _inflight_batches.acquire()
+            future = _insert_executor.submit(
+                _insert_with_retry, collection.with_options(write_concern=_WRITE_CONCERN), records
+            )
+            future.add_done_callback(lambda _: _inflight_batches.release())
+
+def _insert_with_retry(collection, records):
+    """
+    Insert records into the collection, retrying with exponential backoff.
+    Runs on the insert pool, so failures are logged rather than raised.
+    """
+    for attempt in range(_DB_WRITE_ATTEMPTS):
+        try:
+            collection.insert_many(records, ordered=False, bypass_document_validation=True)
+            return
+        except BulkWriteError as e:
+            # Duplicate keys mean an earlier attempt already wrote those records
+            write_errors = e.details.get("writeErrors", [])
+            if all(error.get("code") == 11000 for error in write_errors) and not e.details.get("writeConcernErrors"):
+                return
+            error = e
+        except Exception as e:
+            error = e
+        
+        if attempt == _DB_WRITE_ATTEMPTS - 1:
+            logging.error(f"Error saving to database: {str(error)}")
+            return
+        logging.warning(f"Error saving to database (attempt {attempt + 1}), retrying: {str(error)}")
+        time.sleep(2 ** attempt)
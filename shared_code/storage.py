@@ -0,0 +1,133 @@
+# storage.py
+import os
+import datetime
+import uuid
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob import BlobServiceClient, BlobSasPermissions, generate_blob_sas
+from shared_code.transport import TRANSPORT
+
+# SDK clients are reused across invocations so requests share one connection pool
+_client_lock = threading.Lock()
+_blob_service_cache = {}
+_container_client_cache = {}
+_ensured_containers = set()
+
+# Worker pool for blob uploads that overlap with the rest of the request. Each invocation
+# starts at most one upload, so the pool is as large as the Functions worker's invocation
+# thread pool and an upload never waits for a slot. Unset, both default to min(32, cpu + 4).
+_UPLOAD_WORKERS = int(os.environ["PYTHON_THREADPOOL_THREAD_COUNT"]) if os.environ.get("PYTHON_THREADPOOL_THREAD_COUNT") else None
+_upload_executor = ThreadPoolExecutor(max_workers=_UPLOAD_WORKERS, thread_name_prefix="blob-upload")
+
+def upload_to_blob_storage(connection_string, container_name, blob_prefix, file_name, file_content, metadata=None, timestamp=None, max_concurrency=8):
+    """
+    Upload a file to Azure Blob Storage
+    """
+    if timestamp is None:
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+    # Extract file extension; a leading dot (e.g. ".env") is part of the name, not an extension
+    dot = file_name.rfind('.')
+    file_extension = file_name[dot:] if dot > 0 else ''
+    # Create a unique blob name; the random suffix keeps uploads in the same millisecond apart
+    blob_name = f"{blob_prefix}_{int(timestamp.timestamp() * 1000)}_{uuid.uuid4().hex[:8]}{file_extension}"
+
+    # Get the container client - created on first use if it doesn't exist
+    container_client = get_container_client(connection_string, container_name)
+
+    # Get the blob client
+    blob_client = container_client.get_blob_client(blob_name)
+
+    # Upload the file with its size known up front, letting the SDK send blocks in parallel
+    blob_client.upload_blob(
+        file_content,
+        length=len(file_content),
+        overwrite=True,
+        metadata=metadata,
+        max_concurrency=max_concurrency
+    )
+
+    # Get the blob URL
+    blob_url = blob_client.url
+
+    return blob_client, blob_url
+
+def start_upload(*args, **kwargs):
+    """
+    Run upload_to_blob_storage on the background upload pool and return its Future.
+    The pool is shared by every function in the worker; it matches the invocation threads
+    they share, so uploads from one function never hold up another's.
+    """
+    return _upload_executor.submit(upload_to_blob_storage, *args, **kwargs)
+
+def get_blob_service(connection_string):
+    """
+    Return a cached BlobServiceClient for the connection string
+    """
+    blob_service_client = _blob_service_cache.get(connection_string)
+    if blob_service_client is None:
+        with _client_lock:
+            blob_service_client = _blob_service_cache.get(connection_string)
+            if blob_service_client is None:
+                blob_service_client = BlobServiceClient.from_connection_string(connection_string, transport=TRANSPORT)
+                _blob_service_cache[connection_string] = blob_service_client
+    return blob_service_client
+
+def get_container_client(connection_string, container_name):
+    """
+    Return a cached ContainerClient, creating the container only on first use in this process
+    """
+    cache_key = (connection_string, container_name)
+    container_client = _container_client_cache.get(cache_key)
+    if container_client is None:
+        with _client_lock:
+            container_client = _container_client_cache.get(cache_key)
+            if container_client is None:
+                container_client = get_blob_service(connection_string).get_container_client(container_name)
+                _container_client_cache[cache_key] = container_client
+
+    if cache_key not in _ensured_containers:
+        try:
+            container_client.create_container()
+        except ResourceExistsError:
+            pass
+        _ensured_containers.add(cache_key)
+
+    return container_client
+
+def generate_sas_url(connection_string, container_name, blob_name):
+    """
+    Generate a SAS URL for accessing the blob
+    """
+    # Get account information from the (cached) parsed connection string
+    account_name, account_key = _parse_connection_string(connection_string)
+
+    if not account_name or not account_key:
+        raise ValueError("Could not extract account name and key from connection string")
+
+    # Calculate token expiry time (1 hour from now)
+    expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+
+    # Create SAS token with read permission
+    sas_token = generate_blob_sas(
+        account_name=account_name,
+        account_key=account_key,
+        container_name=container_name,
+        blob_name=blob_name,
+        permission=BlobSasPermissions(read=True),
+        expiry=expiry
+    )
+
+    # Construct the full SAS URL
+    sas_url = f"https://{account_name}.blob.core.windows.net/{container_name}/{blob_name}?{sas_token}"
+
+    return sas_url
+
+@functools.lru_cache(maxsize=4)
+def _parse_connection_string(connection_string):
+    """
+    Extract the account name and key from a storage connection string
+    """
+    account_dict = {item.split('=', 1)[0]: item.split('=', 1)[1] for item in connection_string.split(';') if '=' in item}
+    return account_dict.get('AccountName'), account_dict.get('AccountKey')
@@ -0,0 +1,19 @@
+# transport.py
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+
+# One requests session, and so one connection pool per host, for every Azure SDK client in the worker.
+# The pool is sized for parallel blob block uploads alongside other SDK calls.
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=32)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+# session_owner=False so closing one client does not close the session for the others
+TRANSPORT = RequestsTransport(
+    session=_session,
+    session_owner=False,
+    connection_timeout=30,
+    read_timeout=60
+)
@@ -0,0 +1,83 @@
+# utils.py
+import re
+import orjson
+import azure.functions as func
+
+# Form fields that describe the uploading user rather than the upload
+USER_INFO_KEYS = frozenset(['owner', 'displayName', 'fullName', 'email', 'userId', 'restaurant'])
+
+# Patterns used by convert_to_snake_case
+_NON_WORD_RE = re.compile(r'[^\w\s]')
+_SPACES_RE = re.compile(r'\s+')
+
+def parse_form(req):
+    """
+    Split the form fields of a multipart request into user info and other fields
+    """
+    user_info = {}
+    fields = {}
+
+    for key, value in req.form.items():
+        if key == 'file':
+            continue
+        if key in USER_INFO_KEYS:
+            user_info[key] = value
+        else:
+            fields[key] = value
+
+    return user_info, fields
+
+def get_username(user_info):
+    """
+    Pick the best available display name from user info, as snake_case
+    """
+    username = "unknown"
+    if user_info:
+        if user_info.get("displayName"):
+            username = user_info.get("displayName")
+        elif user_info.get("fullName"):
+            username = user_info.get("fullName")
+        elif user_info.get("owner"):
+            username = user_info.get("owner")
+
+        username = convert_to_snake_case(username)
+
+    return username
+
+def convert_to_snake_case(text):
+    """
+    Convert a display name or text to snake_case format
+    Example: "John Doe" -> "john_doe"
+    """
+    # Replace special characters with underscores, then each run of spaces with a single underscore
+    return _SPACES_RE.sub('_', _NON_WORD_RE.sub('_', str(text))).lower()
+
+def check_content_length(req, max_mb):
+    """
+    Return a 413 response if the request's content-length is over max_mb, before the body is parsed
+    """
+    content_length = req.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > max_mb * 1024 * 1024:
+        return _upload_too_large_response(max_mb)
+    return None
+
+def read_upload(file_data, max_mb):
+    """
+    Read an uploaded file, returning (content, None), or (None, a 413 response) if it is over max_mb.
+    Reading one byte past the limit catches uploads sent without a content-length.
+    """
+    max_bytes = max_mb * 1024 * 1024
+    file_content = file_data.read(max_bytes + 1)
+    if len(file_content) > max_bytes:
+        return None, _upload_too_large_response(max_mb)
+    return file_content, None
+
+def _upload_too_large_response(max_mb):
+    """
+    Build the 413 response for uploads over the size limit
+    """
+    return func.HttpResponse(
+        orjson.dumps({"error": f"File too large. The maximum upload size is {max_mb} MB."}),
+        status_code=413,
+        mimetype="application/json"
+    )